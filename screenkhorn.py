@@ -5,9 +5,160 @@ __author__ = 'Mokhtar Z. Alaya'
 
 import numpy as np
 from scipy.optimize import fmin_l_bfgs_b
+from scipy.linalg.blas import dgemv
 from time import time
 import warnings
 
+# check if bottleneck module exists
+try:
+    import bottleneck
+except ImportError:
+    warnings.warn(
+        "Bottleneck module is not installed. Install it from https://pypi.org/project/Bottleneck/ for better performance.")
+    bottleneck = np
+
+try:
+    from numba import njit, prange, get_num_threads
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
+
+if _HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _reduce_K_numba(K):
+        n, m = K.shape
+        n_chunks = min(n, get_num_threads())
+        row_sums = np.empty(n)
+        # one column accumulator per chunk of rows, merged at the end
+        col_acc = np.zeros((n_chunks, m))
+        for c in prange(n_chunks):
+            for i in range(c * n // n_chunks, (c + 1) * n // n_chunks):
+                rs = 0.
+                for j in range(m):
+                    v = K[i, j]
+                    rs += v
+                    col_acc[c, j] += v
+                row_sums[i] = rs
+        col_sums = np.zeros(m)
+        for c in range(n_chunks):
+            col_sums += col_acc[c]
+        return row_sums, col_sums
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _reduce_gibbs_numba(C, reg):
+        n, m = C.shape
+        n_chunks = min(n, get_num_threads())
+        row_sums = np.empty(n)
+        col_acc = np.zeros((n_chunks, m))
+        for c in prange(n_chunks):
+            for i in range(c * n // n_chunks, (c + 1) * n // n_chunks):
+                rs = 0.
+                for j in range(m):
+                    v = np.exp(- C[i, j] / reg)
+                    rs += v
+                    col_acc[c, j] += v
+                row_sums[i] = rs
+        col_sums = np.zeros(m)
+        for c in range(n_chunks):
+            col_sums += col_acc[c]
+        return row_sums, col_sums
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _gibbs_kernel_numba(C, reg, K):
+        n, m = C.shape
+        for i in prange(n):
+            for j in range(m):
+                K[i, j] = np.exp(- C[i, j] / reg)
+        return K
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _gibbs_block_numba(C, reg, rows, cols):
+        K = np.empty((rows.size, cols.size))
+        for i in prange(rows.size):
+            r = rows[i]
+            for j in range(cols.size):
+                K[i, j] = np.exp(- C[r, cols[j]] / reg)
+        return K
+
+
+def _gibbs_kernel(C, reg, dtype=np.float64):
+    """
+    Gibbs kernel exp(-C / reg), computed in place in an array of the given dtype (in parallel with numba)
+    """
+    K = np.empty(C.shape, dtype=dtype)
+    if _HAS_NUMBA:
+        return _gibbs_kernel_numba(C, reg, K)
+    np.multiply(C, - 1. / reg, out=K)
+    np.exp(K, out=K)
+    return K
+
+
+def _gibbs_block(C, reg, rows, cols):
+    """
+    Block exp(-C[rows, cols] / reg) of the Gibbs kernel, gathered from C and exponentiated in one parallel pass
+    when numba is available
+    """
+    if _HAS_NUMBA:
+        return _gibbs_block_numba(C, reg, rows, cols)
+    return _gibbs_kernel(C[np.ix_(rows, cols)], reg)
+
+
+def _reduce_K(K):
+    """
+    Sums of the rows and of the columns of K, computed in a single pass over K when numba is available
+    """
+    if _HAS_NUMBA:
+        return _reduce_K_numba(K)
+    return K.sum(axis=1, dtype=np.float64), K.sum(axis=0, dtype=np.float64)
+
+
+def _reduce_gibbs(C, reg, block_size=1024):
+    """
+    Sums of the rows and of the columns of exp(-C / reg), streamed from C by blocks of rows without storing the kernel
+    """
+    if _HAS_NUMBA:
+        return _reduce_gibbs_numba(C, reg)
+    row_sums = np.empty(C.shape[0])
+    col_sums = np.zeros(C.shape[1])
+    for start in range(0, C.shape[0], block_size):
+        K_block = _gibbs_kernel(C[start:start + block_size], reg)
+        row_sums[start:start + block_size] = K_block.sum(axis=1)
+        col_sums += K_block.sum(axis=0)
+    return row_sums, col_sums
+
+
+def _nth_largest(x, n, with_next=False):
+    """
+    n-th largest entry of x (mean of the n-th and (n+1)-th largest ones if with_next), by partial sorting
+    """
+    kth = x.size - n
+    if with_next and kth > 0:
+        return np.partition(x, (kth - 1, kth))[kth - 1:kth + 1].mean()
+    return bottleneck.partition(x, kth)[kth]
+
+
+def _restricted_sinkhorn_loop(K_IJ, K_IJ_T, fs_a_I, b_J, cst_u, cst_v, fact_scale, usc, vsc, max_iter):
+    """
+    Fixed-point iterations of the restricted Sinkhorn, updating usc and vsc in place
+    """
+    tmp_u = np.empty_like(usc)
+    tmp_v = np.empty_like(vsc)
+    for _ in range(1, max_iter):
+        np.dot(K_IJ_T, usc, tmp_v)
+        tmp_v += cst_v
+        tmp_v *= fact_scale
+        np.divide(b_J, tmp_v, vsc)
+        np.dot(K_IJ, vsc, tmp_u)
+        tmp_u += cst_u
+        np.divide(fs_a_I, tmp_u, usc)
+    return usc, vsc
+
+
+if _HAS_NUMBA:
+    _restricted_sinkhorn_loop = njit(fastmath=True, cache=True)(_restricted_sinkhorn_loop)
+
+
 class Screenkhorn:
     """
     Screenkhorn: solver of screening Sinkhorn algorithm for discrete regularized optimal transport (OT)
@@ -53,11 +204,31 @@ class Screenkhorn:
     verbose : `bool`, default=True
         If `True`, dispaly informations along iterations
 
+    dtype : `numpy.dtype`, default=numpy.float64
+        Precision of the Gibbs kernel K used in the screening step. With `numpy.float32`, K takes half the memory
+        and the block K_IJ used by the L-BFGS-B solver is recomputed in float64 from C
+
+    keep_kernel : `bool`, default=True
+        If `False`, the full Gibbs kernel K is never stored: the sums needed by the screening test are streamed
+        from C and only the block K_IJ is computed. `self.K` is then `None`
+
+    device : `str` or `torch.device`, default=None
+        If given (e.g. 'cuda'), the objective and its gradient are evaluated with PyTorch on this device at each
+        L-BFGS-B step; only theta and the gradient are transferred between the host and the device
+
+    precompute_transpose : `bool`, default=True
+        If `True`, a row-major copy of K_IJ.T is stored so that both products with K_IJ run along contiguous rows.
+        Set it to `False` to save the memory of this copy when |I| x |J| is large
+
     Dependency
     ----------
     To gain more efficiency, screenkhorn needs to call the "Bottleneck" package (https://pypi.org/project/Bottleneck/)
     in the screening pre-processing step. If Bottleneck isn't installed, the following error message appears:
     "Bottleneck module doesn't exist. Install it from https://pypi.org/project/Bottleneck/"
+    If the "Numba" package (https://pypi.org/project/numba/) is installed, the row and column sums of the Gibbs
+    kernel are computed in a single parallel pass, otherwise plain numpy reductions are used.
+    The `device` option needs the "PyTorch" package (https://pytorch.org/). If it isn't installed, a warning is raised
+    and the objective is evaluated on the CPU.
 
     Returns
     -------
@@ -74,15 +245,8 @@ class Screenkhorn:
 
     """
     def __init__(self, a, b, C, reg, ns_budget=None, nt_budget=None, uniform=False, restricted=True, one_init=False,
-                 maxiter=10000, maxfun=10000, pgtol=1e-09, verbose=True, log=False):
-
-        # check if bottleneck module exists
-        try:
-            import bottleneck
-        except ImportError:
-            warnings.warn(
-                "Bottleneck module is not installed. Install it from https://pypi.org/project/Bottleneck/ for better performance.")
-            bottleneck = np
+                 maxiter=10000, maxfun=10000, pgtol=1e-09, verbose=True, log=False, dtype=np.float64,
+                 keep_kernel=True, device=None, precompute_transpose=True):
 
         # time
         tic_initial = time()
@@ -109,6 +273,20 @@ class Screenkhorn:
         self.pgtol = pgtol
         self.one_init = one_init
         self.log = log
+        self.dtype = np.dtype(dtype)
+        self.keep_kernel = keep_kernel
+        self.device = device
+        self.precompute_transpose = precompute_transpose
+
+        # check if torch module exists when a device is asked for
+        if self.device is not None:
+            try:
+                import torch
+                self._torch = torch
+            except ImportError:
+                warnings.warn(
+                    "PyTorch module is not installed. Install it from https://pytorch.org/ to use a device.")
+                self.device = None
 
         # by default, we keep only 50% of the sample data points
         if self.ns_budget is None:
@@ -116,10 +294,34 @@ class Screenkhorn:
         if self.nt_budget is None:
             self.nt_budget = int(np.floor(0.5 * nt))
 
+        self._screen()
+
+        if self.one_init:
+            print('one initialization')
+        if not self.restricted:
+            print('no restricted')
+        self._warm_start()
+
+        self.toc_initial = time() - tic_initial
+        if self.verbose:
+                print('time of initialization: %s' %self.toc_initial)
+
+    def update(self, C):
+        """
+       we use this function to gain more efficiency in OTDA experiments
+        """
+        self.C = np.asarray(C, dtype=np.float64)
+        self._screen()
+        self._warm_start()
+
+    def _screen(self):
+        """
+        Screening of the active sets I, J and constants of the screened Sinkhorn divergence for the current C
+        """
+        ns, nt = self.C.shape
+
         # calculate the Gibbs kernel K
-        self.K = np.empty_like(self.C)
-        np.divide(self.C, - self.reg, out=self.K)
-        np.exp(self.K, out=self.K)
+        self.K = _gibbs_kernel(self.C, self.reg, self.dtype) if self.keep_kernel else None
 
         # screening test (see Lemma 1 in the paper)
 
@@ -132,69 +334,57 @@ class Screenkhorn:
             self.epsilon = 0.0
             # kappa
             self.fact_scale = 1.0
-            # restricted Sinkhron
-            self.cst_u = 0.
-            self.cst_v = 0.
-            # box constraints in LBFGS
-            self.bounds_u = [(0.0, np.inf)] * ns
-            self.bounds_v = [(0.0, np.inf)] * nt
+            # box constraints in LBFGS, one row (lower, upper) per coordinate of theta = [u, v]
+            self._bounds = np.empty((ns + nt, 2))
+            self._bounds[:, 0] = 0.0
+            self._bounds[:, 1] = np.inf
             #
-            self.K_IJ = self.K
+            if self.K is not None and self.K.dtype == np.float64:
+                self.K_IJ = np.ascontiguousarray(self.K)
+            else:
+                self.K_IJ = _gibbs_kernel(self.C, self.reg)
             self.a_I = self.a
             self.b_J = self.b
-            self.K_IJc = []
-            self.K_IcJ = []
+            # sums of the rows of K_IJc and of the columns of K_IcJ (empty blocks)
+            K_IJc_sum = np.zeros(ns)
+            K_IcJ_sum = np.zeros(nt)
 
         else:
             # sum of rows and columns of K
-            K_sum_cols = self.K.sum(axis=1)
-            K_sum_rows = self.K.sum(axis=0)
+            K_sum_cols, K_sum_rows = self._kernel_sums()
 
             if self.uniform:
-                if ns / self.ns_budget < 4:
-                    aK_sort = np.sort(K_sum_cols)
-                    epsilon_u_square = a[0] / aK_sort[self.ns_budget - 1]
-                else:
-                    aK_sort = bottleneck.partition(K_sum_cols, self.ns_budget-1)[self.ns_budget-1]
-                    epsilon_u_square = a[0] / aK_sort
-
-                if nt / self.nt_budget < 4:
-                    bK_sort = np.sort(K_sum_rows)
-                    epsilon_v_square = b[0]/bK_sort[self.nt_budget - 1]
-                else:
-                    bK_sort = bottleneck.partition(K_sum_rows, self.nt_budget-1)[self.nt_budget-1]
-                    epsilon_v_square = b[0] / bK_sort
+                aK_sort = bottleneck.partition(K_sum_cols, self.ns_budget - 1)[self.ns_budget - 1]
+                epsilon_u_square = self.a[0] / aK_sort
+
+                bK_sort = bottleneck.partition(K_sum_rows, self.nt_budget - 1)[self.nt_budget - 1]
+                epsilon_v_square = self.b[0] / bK_sort
             else:
-                aK = a / K_sum_cols
-                bK = b / K_sum_rows
-                
-                aK_sort = np.sort(aK)[::-1]
-                epsilon_u_square = aK_sort[self.ns_budget - 1]
-            
-                bK_sort = np.sort(bK)[::-1]
-                epsilon_v_square = bK_sort[self.nt_budget - 1]
+                aK = self.a / K_sum_cols
+                bK = self.b / K_sum_rows
+
+                epsilon_u_square = _nth_largest(aK, self.ns_budget)
+                epsilon_v_square = _nth_largest(bK, self.nt_budget)
 
             # I, J
             self.Isel = self.a >= epsilon_u_square * K_sum_cols
             self.Jsel = self.b >= epsilon_v_square * K_sum_rows
              
-            if sum(self.Isel) != self.ns_budget:
-                print("test error", sum(self.Isel), self.ns_budget)
+            if np.count_nonzero(self.Isel) != self.ns_budget:
+                print("test error", np.count_nonzero(self.Isel), self.ns_budget)
                 if self.uniform:
-                    aK = a / K_sum_cols
-                    aK_sort = np.sort(aK)[::-1]
-                epsilon_u_square = aK_sort[self.ns_budget - 1:self.ns_budget+1].mean()
+                    aK = self.a / K_sum_cols
+                epsilon_u_square = _nth_largest(aK, self.ns_budget, with_next=True)
                 self.Isel = self.a >= epsilon_u_square * K_sum_cols
-                self.ns_budget = sum(self.Isel)
+                self.ns_budget = np.count_nonzero(self.Isel)
             
-            if sum(self.Jsel) != self.nt_budget:
-                print("test error", sum(self.Jsel), self.nt_budget)
+            if np.count_nonzero(self.Jsel) != self.nt_budget:
+                print("test error", np.count_nonzero(self.Jsel), self.nt_budget)
                 if self.uniform:
-                    bK = b / K_sum_rows
-                    bK_sort = np.sort(bK)[::-1]
-                epsilon_v_square = bK_sort[self.nt_budget - 1:self.nt_budget+1].mean()
+                    bK = self.b / K_sum_rows
+                epsilon_v_square = _nth_largest(bK, self.nt_budget, with_next=True)
                 self.Jsel = self.b >= epsilon_v_square * K_sum_rows
-                self.nt_budget = sum(self.Jsel)
+                self.nt_budget = np.count_nonzero(self.Jsel)
 
             # epsilon, kappa
             self.epsilon = (epsilon_u_square * epsilon_v_square)**(1/4)
@@ -203,16 +393,16 @@ class Screenkhorn:
             if self.verbose:
                 print("epsilon = %s\n" % self.epsilon)
                 print("kappa = %s\n" % self.fact_scale)
-                print('Cardinality of selected points: |Isel| = %s \t |Jsel| = %s \n' % (sum(self.Isel), sum(self.Jsel)))
+                print('Cardinality of selected points: |Isel| = %s \t |Jsel| = %s \n' % (np.count_nonzero(self.Isel), np.count_nonzero(self.Jsel)))
 
-            # Ic, Jc: complementary sets of I and J
-            self.Ic = ~self.Isel
-            self.Jc = ~self.Jsel
+            # I, J as index arrays
+            self.I = np.flatnonzero(self.Isel)
+            self.J = np.flatnonzero(self.Jsel)
 
            # K
-            self.K_IJ = self.K[np.ix_(self.Isel, self.Jsel)]
-            self.K_IcJ = self.K[np.ix_(self.Ic, self.Jsel)]
-            self.K_IJc = self.K[np.ix_(self.Isel, self.Jc)]
+            self.K_IJ = self._kernel_block(self.I, self.J)
+            # sums of the rows of K_IJc and of the columns of K_IcJ, without building these blocks
+            K_IJc_sum, K_IcJ_sum = self._complement_sums(K_sum_cols, K_sum_rows)
             K_min = self.K_IJ.min()
             if K_min == 0:
                 K_min = np.finfo(float).tiny  
@@ -232,222 +422,175 @@ class Screenkhorn:
                 self.b_J_min = self.b_J[0]
             
             # box constraints in L-BFGS-B (see Proposition 1 in the paper)
-            self.bounds_u = [(max(self.a_I_min / (self.epsilon * (nt - self.nt_budget) \
+            # the bounds are the same for all the coordinates of u, and for all the ones of v
+            self._bounds = np.empty((self.ns_budget + self.nt_budget, 2))
+            self._bounds[:self.ns_budget, 0] = max(self.a_I_min / (self.epsilon * (nt - self.nt_budget) \
                                                     + self.nt_budget * (self.b_J_max / (self.epsilon *  self.fact_scale * ns * K_min))), \
-                                  self.epsilon / self.fact_scale), \
-                              self.a_I_max / (self.epsilon * nt * K_min))] * self.ns_budget
+                                                   self.epsilon / self.fact_scale)
+            self._bounds[:self.ns_budget, 1] = self.a_I_max / (self.epsilon * nt * K_min)
 
-            self.bounds_v = [(max(self.b_J_min / (self.epsilon * (ns - self.ns_budget) \
+            self._bounds[self.ns_budget:, 0] = max(self.b_J_min / (self.epsilon * (ns - self.ns_budget) \
                                                     + self.ns_budget * (self.fact_scale * self.a_I_max / (self.epsilon * nt * K_min))), \
-                                  self.epsilon * self.fact_scale), \
-                              self.b_J_max / (self.epsilon * ns * K_min))] * self.nt_budget
+                                                   self.epsilon * self.fact_scale)
+            self._bounds[self.ns_budget:, 1] = self.b_J_max / (self.epsilon * ns * K_min)
+
+        # row-major copy of K_IJ.T so that products with u run along contiguous rows, or just a view
+        if self.precompute_transpose:
+            self.K_IJ_T = np.ascontiguousarray(self.K_IJ.T)
+        else:
+            self.K_IJ_T = self.K_IJ.T
 
         # constants in the objective function of the screened Sinkhorn divergence
-        self.vec_eps_IJc = self.epsilon * self.fact_scale \
-                           * (self.K_IJc * np.ones(nt - self.nt_budget).reshape((1, -1))).sum(axis=1)
-        self.vec_eps_IcJ = (self.epsilon / self.fact_scale) \
-                           * (np.ones(ns - self.ns_budget).reshape((-1, 1)) * self.K_IcJ).sum(axis=0)
+        # constants depending on epsilon and kappa used at each evaluation
+        self._inv_fs = 1. / self.fact_scale
+        self._eps_over_fs = self.epsilon * self._inv_fs
+        self._eps_times_fs = self.epsilon * self.fact_scale
+        self._fs_a_I = self.fact_scale * self.a_I
+        self._b_J_over_fs = self._inv_fs * self.b_J
 
-        # restricted-Sinkhron
-        if self.ns_budget != ns or self.ns_budget != nt:
-            self.cst_u = self.fact_scale * self.epsilon * self.K_IJc.sum(axis=1)
-            self.cst_v = self.epsilon * self.K_IcJ.sum(axis=0) / self.fact_scale
+        self.vec_eps_IJc = self._eps_times_fs * K_IJc_sum
+        self.vec_eps_IcJ = self._eps_over_fs * K_IcJ_sum
 
-        if not self.one_init:
-            u0 = np.full(self.ns_budget, (1. / self.ns_budget) + self.epsilon / self.fact_scale)
-            v0 = np.full(self.nt_budget, (1. / self.nt_budget) + self.epsilon * self.fact_scale)
-        else:
-            print('one initialization')
-            u0 = np.full(self.ns_budget, 1.)
-            v0 = np.full(self.nt_budget, 1.)
-        
-        if self.restricted:
-            self.u0, self.v0 = self._restricted_sinkhorn(u0, v0, max_iter=5)
-        else:
-            print('no restricted')
-            self.u0 = u0
-            self.v0 = v0
+        # restricted-Sinkhron: its constants are the same as the ones of the objective
+        self.cst_u = self.vec_eps_IJc
+        self.cst_v = self.vec_eps_IcJ
 
-        self.toc_initial = time() - tic_initial
-        if self.verbose:
-                print('time of initialization: %s' %self.toc_initial)
-
-    def update(self, C):
+    def _warm_start(self):
         """
-       we use this function to gain more efficiency in OTDA experiments
+        Initial point of L-BFGS-B, refined by the restricted Sinkhorn if `restricted`
         """
-        self.C = np.asarray(C, dtype=np.float64)
-        nt = C.shape[0]
-        ns = C.shape[1]
-        self.K = np.exp(-self.C / self.reg)
-
-        # sum of rows and columns of K
-        K_sum_cols = self.K.sum(axis=1)
-        K_sum_rows = self.K.sum(axis=0)
-                      
-        if self.uniform:
-            if ns / self.ns_budget < 4:
-                aK_sort = np.sort(K_sum_cols)
-                epsilon_u_square = self.a[0] / aK_sort[self.ns_budget - 1]
-            else :
-                aK_sort = bottleneck.partition(K_sum_cols, self.ns_budget-1)[self.ns_budget-1]
-                epsilon_u_square = self.a[0] / aK_sort
-                
-            if nt / self.nt_budget < 4:
-                bK_sort = np.sort(K_sum_rows)
-                epsilon_v_square = self.b[0] / bK_sort[self.nt_budget - 1]
-            else:
-                bK_sort = bottleneck.partition(K_sum_rows, self.nt_budget-1)[self.nt_budget-1]
-                epsilon_v_square = self.b[0] / bK_sort
-                
-        else:
-            aK = self.a / K_sum_cols
-            bK = self.b / K_sum_rows
-            
-            aK_sort = np.sort(aK)[::-1]
-            epsilon_u_square = aK_sort[self.ns_budget - 1]
-            bK_sort = np.sort(bK)[::-1]
-            epsilon_v_square = bK_sort[self.nt_budget - 1] 
-        
-        # I, J
-        self.Isel = self.a >= epsilon_u_square * K_sum_cols
-        self.Jsel = self.b >= epsilon_v_square * K_sum_rows
-                      
-        if sum(self.Isel) != self.ns_budget:
-            if self.uniform:
-                aK = self.a / K_sum_cols
-            aK_sort = np.sort(aK)[::-1]
-            epsilon_u_square = aK_sort[self.ns_budget - 1:self.ns_budget+1].mean()
-            self.Isel = self.a >= epsilon_u_square * K_sum_cols
-            self.ns_budget = sum(self.Isel)
-            
-        if sum(self.J) != self.nt_budget:
-            if self.uniform:
-                bK = self.b / K_sum_rows
-            bK_sort = np.sort(bK)[::-1]
-            epsilon_v_square = bK_sort[self.nt_budget - 1:self.nt_budget+1].mean()
-            self.Jsel = self.b >= epsilon_v_square * K_sum_rows
-            self.nt_budget = sum(self.Jsel)
-
-        self.epsilon = (epsilon_u_square * epsilon_v_square)**(1/4)
-        self.fact_scale = (epsilon_v_square / epsilon_u_square)**(1/2)
-
-         # Ic, Jc
-        self.Ic = ~self.Isel
-        self.Jc = ~self.Jsel
-
-        # K
-        self.K_IJ = self.K[np.ix_(self.Isel, self.Jsel)]
-        self.K_IcJ = self.K[np.ix_(self.Ic, self.Jsel)]
-        self.K_IJc = self.K[np.ix_(self.Isel, self.Jc)]
-        K_min = self.K_IJ.min()
-        if K_min == 0:
-            K_min = np.finfo(float).tiny
-
-        # a_I,b_J,a_Ic,b_Jc
-        self.a_I = self.a[self.Isel]
-        self.b_J = self.b[self.Jsel]
-        if not self.uniform:
-                self.a_I_min = self.a_I.min()
-                self.a_I_max = self.a_I.max()
-                self.b_J_max = self.b_J.max()
-                self.b_J_min = self.b_J.min()
-        else:
-                self.a_I_min = self.a_I[0]
-                self.a_I_max = self.a_I[0]
-                self.b_J_max = self.b_J[0]
-                self.b_J_min = self.b_J[0]
-
-        # box constraints in LBFGS solver (see Proposition 1 in the paper)
-        self.bounds_u = [(max(self.a_I_min / (self.epsilon * (nt - self.nt_budget) \
-                                                    + self.nt_budget * (self.b_J_max / (self.epsilon *  self.fact_scale * ns * K_min))), \
-                                  self.epsilon / self.fact_scale), \
-                              self.a_I_max / (self.epsilon * nt * K_min))] * self.ns_budget
-
-        self.bounds_v = [(max(self.b_J_min / (self.epsilon * (ns - self.ns_budget) \
-                                                    + self.ns_budget * (self.fact_scale * self.a_I_max / (self.epsilon * nt * K_min))), \
-                                  self.epsilon * self.fact_scale), \
-                              self.b_J_max / (self.epsilon * ns * K_min))] * self.nt_budget
-
-        self.vec_eps_IJc = self.epsilon * self.fact_scale \
-                           * (self.K_IJc * np.ones(nt-self.nt_budget).reshape((1, -1))).sum(axis=1)
-        self.vec_eps_IcJ = (self.epsilon / self.fact_scale) \
-                           * (np.ones(ns-self.ns_budget).reshape((-1, 1)) * self.K_IcJ).sum(axis=0)
-
-        # pre-calculed constans for restricted Sinkhron
-        if self.ns_budget != ns or self.ns_budget != nt:
-            self.cst_u = self.fact_scale * self.epsilon * self.K_IJc.sum(axis=1)
-            self.cst_v = self.epsilon * self.K_IcJ.sum(axis=0) / self.fact_scale
-
         if not self.one_init:
-            u0 = np.full(self.ns_budget, (1. / self.ns_budget) + self.epsilon / self.fact_scale)
-            v0 = np.full(self.nt_budget, (1. / self.nt_budget) + self.epsilon * self.fact_scale)
+            u0 = np.full(self.ns_budget, (1. / self.ns_budget) + self._eps_over_fs)
+            v0 = np.full(self.nt_budget, (1. / self.nt_budget) + self._eps_times_fs)
         else:
             u0 = np.full(self.ns_budget, 1.)
             v0 = np.full(self.nt_budget, 1.)
-        
+
         if self.restricted:
             self.u0, self.v0 = self._restricted_sinkhorn(u0, v0, max_iter=5)
         else:
             self.u0 = u0
             self.v0 = v0
 
-    def _projection(self, u, epsilon):
-        u[u <= epsilon] = epsilon
-        return u
+    def _kernel_block(self, rows, cols):
+        """
+        Block K[rows, cols] of the Gibbs kernel as a C-contiguous float64 array
+        """
+        if self.K is not None and self.K.dtype == np.float64:
+            return np.ascontiguousarray(self.K[np.ix_(rows, cols)])
+        return _gibbs_block(self.C, self.reg, rows, cols)
 
-    def _objective(self, u_param, v_param):
-        part_IJ = u_param @ self.K_IJ @ v_param\
-                  - self.fact_scale * self.a_I @ np.log(u_param) - (1. / self.fact_scale) * self.b_J @ np.log(v_param)
-        part_IJc = u_param @ self.vec_eps_IJc
-        part_IcJ = self.vec_eps_IcJ @ v_param
-        psi_epsilon = part_IJ + part_IJc + part_IcJ
-        return psi_epsilon
+    def _complement_sums(self, K_sum_cols, K_sum_rows):
+        """
+        Sums of the rows of K_IJc and of the columns of K_IcJ, as the sums over K minus the ones over K_IJ
+        (clipped at 0 against rounding errors)
+        """
+        K_IJc_sum = np.maximum(K_sum_cols[self.I] - self.K_IJ.sum(axis=1), 0.)
+        K_IcJ_sum = np.maximum(K_sum_rows[self.J] - self.K_IJ.sum(axis=0), 0.)
+        return K_IJc_sum, K_IcJ_sum
 
-    def _grad_objective(self, u_param, v_param):
-        # gradients of Psi_epsilon wrt u and v
-        grad_u = self.K_IJ @ v_param + self.vec_eps_IJc - self.fact_scale * self.a_I / u_param
-        grad_v = self.K_IJ.T @ u_param + self.vec_eps_IcJ - (1. / self.fact_scale) * self.b_J / v_param
-        return grad_u, grad_v
+    def _kernel_sums(self):
+        """
+        Sums of the rows and of the columns of the Gibbs kernel, streamed from C if K isn't stored
+        """
+        if self.K is None:
+            return _reduce_gibbs(self.C, self.reg)
+        return _reduce_K(self.K)
 
     def _restricted_sinkhorn(self, usc, vsc, max_iter=5):
         """
         Restricted Sinkhorn as a warm-start initialized point for LBFGSB
         """
-        cpt = 1
-        while (cpt < max_iter):
-            K_IJ_v = self.K_IJ.T @ usc + self.cst_v
-            vsc = self.b_J / (self.fact_scale * K_IJ_v)
-            KIJ_u = self.K_IJ @ vsc + self.cst_u
-            usc = (self.fact_scale * self.a_I) / KIJ_u
-            cpt += 1
+        usc, vsc = _restricted_sinkhorn_loop(self.K_IJ, self.K_IJ_T, self._fs_a_I, self.b_J,
+                                             self.cst_u, self.cst_v, self.fact_scale,
+                                             np.array(usc, dtype=np.float64), np.array(vsc, dtype=np.float64),
+                                             max_iter)
 
-        usc = self._projection(usc, self.epsilon / self.fact_scale)
-        vsc = self._projection(vsc, self.epsilon * self.fact_scale)
+        # projection onto the lower bounds epsilon / kappa and epsilon * kappa
+        usc = np.maximum(usc, self._eps_over_fs, out=usc)
+        vsc = np.maximum(vsc, self._eps_times_fs, out=vsc)
 
         return usc, vsc
 
     def _bfgspost(self, theta):
+        """
+        Objective value and gradient of Psi_epsilon, sharing the products with K_IJ
+        """
         u = theta[:self.ns_budget]
         v = theta[self.ns_budget:]
+        # the transposes of the row-major K_IJ and K_IJ_T are column-major views for BLAS
+        K_IJ_v = dgemv(1., self.K_IJ.T, v, 0., self._K_IJ_v, trans=1, overwrite_y=1)
+        if self.precompute_transpose:
+            K_IJ_T_u = dgemv(1., self.K_IJ_T.T, u, 0., self._K_IJ_T_u, trans=1, overwrite_y=1)
+        else:
+            K_IJ_T_u = dgemv(1., self.K_IJ_T, u, 0., self._K_IJ_T_u, overwrite_y=1)
+        # gradients of Psi_epsilon wrt u and v, written in place in the buffer allocated by lbfgsb,
+        # starting with their linear parts; K_IJ v + vec_eps_IJc also gives u K_IJ v + u vec_eps_IJc
+        # in the objective with a single dot product
+        g_u = np.add(K_IJ_v, self.vec_eps_IJc, out=self._g[:self.ns_budget])
+        g_v = np.add(K_IJ_T_u, self.vec_eps_IcJ, out=self._g[self.ns_budget:])
+        # objective value, with the logarithms of u and v taken in one pass over theta
+        log_theta = np.log(theta, out=self._log_theta)
+        f = u @ g_u + self.vec_eps_IcJ @ v \
+            - self._fs_a_I @ log_theta[:self.ns_budget] - self._b_J_over_fs @ log_theta[self.ns_budget:]
+        # the product buffers are free again and hold kappa a_I / u and b_J / (kappa v)
+        g_u -= np.divide(self._fs_a_I, u, out=self._K_IJ_v)
+        g_v -= np.divide(self._b_J_over_fs, v, out=self._K_IJ_T_u)
+        return f, self._g
+
+    def _to_device(self):
+        """
+        Copies on the torch device of the arrays used in the objective of the screened Sinkhorn divergence
+        """
+        def to_device(x):
+            return self._torch.as_tensor(x, dtype=self._torch.float64, device=self.device)
+        self._K_IJ_dev = to_device(self.K_IJ)
+        self._fs_a_I_dev = to_device(self._fs_a_I)
+        self._b_J_over_fs_dev = to_device(self._b_J_over_fs)
+        self._vec_eps_IJc_dev = to_device(self.vec_eps_IJc)
+        self._vec_eps_IcJ_dev = to_device(self.vec_eps_IcJ)
+
+    def _bfgspost_device(self, theta):
+        """
+        Objective value and gradient of Psi_epsilon, computed on the torch device
+        """
+        theta_dev = self._torch.from_numpy(theta).to(self.device)
+        u = theta_dev[:self.ns_budget]
+        v = theta_dev[self.ns_budget:]
+        K_IJ_v = self._K_IJ_dev @ v
+        K_IJ_T_u = u @ self._K_IJ_dev
         # objective value
-        f = self._objective(u, v)
-        # gradient
-        g_u, g_v = self._grad_objective(u, v)
-        g = np.hstack([g_u, g_v])
-        return f, g
+        log_theta = self._torch.log(theta_dev)
+        part_IJ = u @ K_IJ_v \
+                  - self._fs_a_I_dev @ log_theta[:self.ns_budget] - self._b_J_over_fs_dev @ log_theta[self.ns_budget:]
+        part_IJc = u @ self._vec_eps_IJc_dev
+        part_IcJ = self._vec_eps_IcJ_dev @ v
+        f = part_IJ + part_IJc + part_IcJ
+        # gradients of Psi_epsilon wrt u and v
+        g_u = K_IJ_v + self._vec_eps_IJc_dev - self._fs_a_I_dev / u
+        g_v = K_IJ_T_u + self._vec_eps_IcJ_dev - self._b_J_over_fs_dev / v
+        g = self._torch.cat((g_u, g_v))
+        return f.item(), g.cpu().numpy()
 
     def lbfgsb(self):
 
         (ns, nt) = self.C.shape
 
         theta0 = np.hstack([self.u0, self.v0])
-        bounds = self.bounds_u + self.bounds_v  # constraint bounds
-        obj = lambda theta: self._bfgspost(theta)
+        if self.device is None:
+            # buffers of _bfgspost for the gradient, log(theta) and the products with K_IJ
+            self._g = np.empty(self.ns_budget + self.nt_budget)
+            self._log_theta = np.empty(self.ns_budget + self.nt_budget)
+            self._K_IJ_v = np.empty(self.ns_budget)
+            self._K_IJ_T_u = np.empty(self.nt_budget)
+            obj = self._bfgspost
+        else:
+            self._to_device()
+            obj = self._bfgspost_device
 
         theta, _, d = fmin_l_bfgs_b(func=obj,
                                       x0=theta0,
-                                      bounds=bounds,
+                                      bounds=self._bounds,
                                       maxfun=self.maxfun,
                                       pgtol=self.pgtol,
                                       maxiter=self.maxiter)
@@ -455,8 +598,8 @@ class Screenkhorn:
         usc = theta[:self.ns_budget]
         vsc = theta[self.ns_budget:]
 
-        usc_full = np.full(ns, self.epsilon / self.fact_scale)
-        vsc_full = np.full(nt, self.epsilon * self.fact_scale)
+        usc_full = np.full(ns, self._eps_over_fs)
+        vsc_full = np.full(nt, self._eps_times_fs)
         usc_full[self.Isel] = usc
         vsc_full[self.Jsel] = vsc
 
@@ -468,8 +611,13 @@ class Screenkhorn:
             log['Isel'] = self.Isel
             log['Jsel'] = self.Jsel
 
-        Psc = usc_full.reshape((-1, 1)) * self.K * vsc_full.reshape((1, -1))
-        Psc = Psc / Psc.sum()
+        if self.K is None:
+            Psc = _gibbs_kernel(self.C, self.reg)
+            Psc *= usc_full.reshape((-1, 1))
+        else:
+            Psc = usc_full.reshape((-1, 1)) * self.K
+        Psc *= vsc_full.reshape((1, -1))
+        Psc /= Psc.sum()
 
         if self.log:
             return Psc, log